@@ -0,0 +1,193 @@
+"""
+Shared Gemini agent wrapper and agent definitions for both Streamlit entry
+points (app.py and main.py). Entry points call genai.configure() before
+make_agents(); this module never configures the API itself.
+"""
+
+import time
+import random
+import asyncio
+import weakref
+import functools
+import threading
+
+import google.generativeai as genai
+from google.api_core import exceptions as api_exceptions
+
+# =========================
+# Rate Limiting
+# =========================
+class TokenBucket:
+    """Thread-safe token bucket; acquire() blocks until a token is available."""
+
+    def __init__(self, capacity: float, refill_per_sec: float):
+        self.capacity = capacity
+        self.refill_per_sec = refill_per_sec
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: float = 1.0):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity,
+                    self.tokens + (now - self.updated) * self.refill_per_sec,
+                )
+                self.updated = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.refill_per_sec
+            time.sleep(wait)
+
+# Sized to a 500 requests-per-minute quota tier; spends bursts, then paces
+_bucket = TokenBucket(capacity=500, refill_per_sec=500 / 60)
+
+# Cap on in-flight async calls so a fan-out doesn't hammer the quota at once
+_MAX_CONCURRENCY = 8
+_semaphores: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore]" = (
+    weakref.WeakKeyDictionary()
+)
+_semaphores_lock = threading.Lock()
+
+def _concurrency_gate() -> asyncio.Semaphore:
+    """Semaphore scoped to the running event loop (asyncio.run makes a fresh
+    loop per button click, and semaphores can't cross loops). Streamlit runs
+    each user session in its own thread, so several loops can be live at once:
+    the registry is keyed weakly by loop — dead loops fall out on their own —
+    and guarded by a lock against concurrent sessions."""
+    loop = asyncio.get_running_loop()
+    with _semaphores_lock:
+        sem = _semaphores.get(loop)
+        if sem is None:
+            sem = _semaphores[loop] = asyncio.Semaphore(_MAX_CONCURRENCY)
+        return sem
+
+def _retry_delay(exc: Exception, attempt: int) -> float:
+    """Honor the server-suggested retry delay when present, otherwise
+    exponential backoff with jitter so parallel callers don't retry in sync."""
+    suggested = getattr(getattr(exc, "retry", None), "initial", None)
+    if suggested is not None:
+        return suggested
+    return 2 ** attempt + random.uniform(0, 2 ** attempt)
+
+# =========================
+# Gemini Agent Wrapper
+# =========================
+@functools.lru_cache(maxsize=4)
+def _model(name: str) -> genai.GenerativeModel:
+    """One GenerativeModel per model name, so agents share its connection pool."""
+    return genai.GenerativeModel(name)
+
+class GeminiAgent:
+    def __init__(self, name: str, instructions: str, model: str = "gemini-2.5-flash"):
+        self.name = name
+        self.instructions = instructions
+        self.model_name = model
+        self.client = _model(self.model_name)
+
+    def run(self, prompt: str) -> str:
+        """Generate content using Gemini; rate-limited, with retry on transient errors."""
+        full_prompt = f"{self.instructions}\n\nUser query / task:\n{prompt}"
+        for attempt in range(3):
+            _bucket.acquire()
+            try:
+                resp = self.client.generate_content(full_prompt)
+                text = getattr(resp, "text", None)
+                return text if text else "No response."
+            except api_exceptions.ResourceExhausted as e:
+                # quota hit despite the bucket; back off per the server's hint
+                if attempt < 2:
+                    time.sleep(_retry_delay(e, attempt))
+                    continue
+                return f"⚠️ Error from {self.name}: {e}"
+            except Exception as e:
+                # naive backoff for other transient failures
+                if attempt < 2:
+                    time.sleep(2 * (attempt + 1))
+                    continue
+                return f"⚠️ Error from {self.name}: {e}"
+
+    def stream(self, prompt: str):
+        """Stream the response chunk-by-chunk for progressive rendering."""
+        full_prompt = f"{self.instructions}\n\nUser query / task:\n{prompt}"
+        _bucket.acquire()
+        return self.client.generate_content(full_prompt, stream=True)
+
+    def build_request(self, prompt: str) -> dict:
+        """Request payload for a Gemini Batch Mode submission of this call."""
+        full_prompt = f"{self.instructions}\n\nUser query / task:\n{prompt}"
+        return {
+            "model": self.model_name,
+            "contents": [{"role": "user", "parts": [{"text": full_prompt}]}],
+        }
+
+    async def arun(self, prompt: str) -> str:
+        """Async variant of run(); lets independent agent calls overlap."""
+        full_prompt = f"{self.instructions}\n\nUser query / task:\n{prompt}"
+        async with _concurrency_gate():
+            for attempt in range(3):
+                await asyncio.to_thread(_bucket.acquire)
+                try:
+                    resp = await self.client.generate_content_async(full_prompt)
+                    text = getattr(resp, "text", None)
+                    return text if text else "No response."
+                except api_exceptions.ResourceExhausted as e:
+                    if attempt < 2:
+                        await asyncio.sleep(_retry_delay(e, attempt))
+                        continue
+                    return f"⚠️ Error from {self.name}: {e}"
+                except Exception as e:
+                    # naive backoff for other transient failures
+                    if attempt < 2:
+                        await asyncio.sleep(2 * (attempt + 1))
+                        continue
+                    return f"⚠️ Error from {self.name}: {e}"
+
+# =========================
+# Agent Definitions
+# =========================
+def make_agents() -> dict[str, GeminiAgent]:
+    """Construct the four pipeline agents. genai.configure() must already
+    have been called by the entry point."""
+    return {
+        "triage": GeminiAgent(
+            name="Triage Agent",
+            instructions=(
+                "You are the coordinator. Given a topic, produce a research plan as pure JSON only.\n"
+                "Keys: topic (string), search_queries (3-5 items), focus_areas (3-5 items).\n"
+                "Do not add commentary outside JSON."
+            ),
+            model="gemini-2.5-flash",
+        ),
+        "research": GeminiAgent(
+            name="Research Agent",
+            instructions=(
+                "You are a research assistant. Summarize findings in 2-3 short paragraphs, "
+                "under 300 words. Focus on crisp facts, key points, and useful takeaways. "
+                "No fluff. Include bulleted lists if helpful."
+            ),
+            model="gemini-2.5-flash",
+        ),
+        "editor": GeminiAgent(
+            name="Editor Agent",
+            instructions=(
+                "You are a senior researcher. Using the notes, write a comprehensive markdown report "
+                "(>= 1000 words, target ~5-10 pages). Include:\n"
+                "- A clear title\n- An outline of sections\n- Well-structured headings\n"
+                "- Evidence-backed points\n- A 'Sources' section at the end"
+            ),
+            model="gemini-2.5-flash",
+        ),
+        "critic": GeminiAgent(
+            name="Critic Agent",
+            instructions=(
+                "You are a critical reviewer. Review the provided report for clarity, structure, depth, "
+                "coverage, and factual balance. Suggest improvements and highlight missing points "
+                "in <= 400 words. Return feedback in markdown with bullet points."
+            ),
+            model="gemini-2.5-flash",
+        ),
+    }
@@ -1,14 +1,21 @@
 import os
 import re
-import json
 import uuid
 import time
+import asyncio
+import hashlib
+import shelve
 from datetime import datetime
 
+import numpy as np
 import streamlit as st
 from dotenv import load_dotenv
 from pydantic import BaseModel, ValidationError
 import google.generativeai as genai
+from google import genai as google_genai  # newer SDK; only it exposes Batch Mode
+
+from agents import GeminiAgent, make_agents
+from json_utils import safe_json_parse
 
 # =========================
 # Environment & API Setup
@@ -41,6 +48,9 @@ defaults = {
     "research_done": False,
     "report_result": None,
     "critique_result": None,
+    "report_title": None,
+    "report_bytes": None,
+    "critique_bytes": None,
 }
 for k, v in defaults.items():
     if k not in st.session_state:
@@ -78,100 +88,205 @@ class ResearchReport(BaseModel):
     word_count: int
 
 # =========================
-# Helpers
+# Parsing
 # =========================
-def extract_json(text: str) -> str | None:
+# Above this size the brace scan is slow enough to matter on the event loop
+_PARSE_OFFLOAD_CHARS = 100_000
+
+async def _parse_json_async(raw: str, fallback: dict) -> dict:
+    """safe_json_parse, but offloaded to a thread for very large payloads so
+    the CPU-bound scan doesn't stall concurrent agent calls. Small inputs
+    stay on the loop to avoid the thread-hop overhead."""
+    if len(raw) > _PARSE_OFFLOAD_CHARS:
+        return await asyncio.to_thread(safe_json_parse, raw, fallback)
+    return safe_json_parse(raw, fallback)
+
+def distill_for_critic(md: str, max_chars: int = 4000) -> str:
     """
-    Try to extract a JSON object from a freeform LLM response.
-    Handles code fences and extra text.
+    Compress a markdown report for the Critic: keep headings verbatim plus the
+    first two sentences of each section. The critic returns <= 400 words of
+    structural feedback, so it doesn't need the full prose — this cuts its
+    input tokens roughly 3x.
     """
-    if not text:
+    if len(md) <= max_chars:
+        return md
+    pieces = []
+    used = 0
+    for section in re.split(r"\n(?=#{1,6} )", md):
+        heading, _, body = section.partition("\n")
+        if not heading.lstrip().startswith("#"):
+            body = section
+            heading = ""
+        if heading:
+            pieces.append(heading.strip())
+            used += len(heading)
+        snippet = ". ".join(s.strip() for s in body.strip().split(". ")[:2]).strip()
+        if snippet:
+            if not snippet.endswith("."):
+                snippet += "."
+            pieces.append(snippet)
+            used += len(snippet)
+        if used > max_chars:
+            break
+    return "\n\n".join(pieces)[:max_chars]
+
+# =========================
+# Prompt Cache (exact + semantic tiers)
+# =========================
+_SIM_THRESHOLD = 0.92
+_CACHE_DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".prompt_cache")
+
+def _prompt_key(agent_name: str, prompt: str) -> str:
+    return hashlib.sha256(f"{agent_name}\n{prompt}".encode("utf-8")).hexdigest()
+
+def _embed(prompt: str) -> np.ndarray | None:
+    """Embed a prompt for semantic lookup; None if embedding fails."""
+    try:
+        result = genai.embed_content(model="text-embedding-004", content=prompt)
+        return np.asarray(result["embedding"], dtype=np.float32)
+    except Exception:
         return None
-    # Try code-fence first
-    fence = re.search(r"```(?:json)?\s*(\{.*?\})\s*```", text, flags=re.DOTALL)
-    if fence:
-        return fence.group(1)
-    # Try first {...} block
-    brace = re.search(r"(\{.*\})", text, flags=re.DOTALL)
-    if brace:
-        return brace.group(1)
-    return None
-
-def safe_json_parse(plan_text: str, fallback: dict) -> dict:
-    payload = extract_json(plan_text) or plan_text
+
+def _init_cache_state():
+    """Load the cache for this conversation from disk into session state."""
+    if "prompt_cache" in st.session_state:
+        return
     try:
-        return json.loads(payload)
+        with shelve.open(_CACHE_DB_PATH) as db:
+            saved = db.get(st.session_state.conversation_id, {})
     except Exception:
-        return fallback
+        saved = {}
+    st.session_state.prompt_cache = saved.get("prompt_cache", {})
+    # entries are (agent_name, embedding, prompt, response); drop older formats
+    st.session_state.embedding_index = [
+        e for e in saved.get("embedding_index", []) if len(e) == 4
+    ]
 
-# =========================
-# Gemini Agent Wrapper
-# =========================
-class GeminiAgent:
-    def __init__(self, name: str, instructions: str, model: str = "gemini-2.5-flash"):
-        self.name = name
-        self.instructions = instructions
-        self.model_name = model
-        self.client = genai.GenerativeModel(self.model_name)
-
-    def run(self, prompt: str) -> str:
-        """Generate content using Gemini; minimal retry on transient errors."""
-        full_prompt = f"{self.instructions}\n\nUser query / task:\n{prompt}"
-        for attempt in range(3):
-            try:
-                resp = self.client.generate_content(full_prompt)
-                text = getattr(resp, "text", None)
-                return text if text else "No response."
-            except Exception as e:
-                # naive backoff for rate limits/transient failures
-                if attempt < 2:
-                    time.sleep(2 * (attempt + 1))
-                    continue
-                return f"⚠️ Error from {self.name}: {e}"
+def _persist_cache():
+    try:
+        with shelve.open(_CACHE_DB_PATH) as db:
+            db[st.session_state.conversation_id] = {
+                "prompt_cache": st.session_state.prompt_cache,
+                "embedding_index": st.session_state.embedding_index,
+            }
+    except Exception:
+        pass  # cache persistence is best-effort
+
+_init_cache_state()
+
+def _cache_lookup(agent_name: str, prompt: str) -> tuple[str | None, np.ndarray | None]:
+    """
+    Two-tier lookup: exact match on (agent name, prompt) hash, then semantic
+    match via embedding cosine similarity > threshold. Returns (response, query
+    embedding); the embedding is handed back so a miss can be stored later
+    without re-embedding.
+    """
+    key = _prompt_key(agent_name, prompt)
+    exact = st.session_state.prompt_cache.get(key)
+    if exact is not None:
+        return exact, None
+
+    query_emb = _embed(prompt)
+    # only compare against the same agent's prompts: different agents' prompts
+    # about one topic (e.g. the editor's report vs. the critic's excerpt of
+    # it) can clear the threshold while their responses aren't interchangeable
+    candidates = [e for e in st.session_state.embedding_index if e[0] == agent_name]
+    if query_emb is not None and candidates:
+        matrix = np.stack([entry[1] for entry in candidates])
+        sims = matrix @ query_emb / (
+            np.linalg.norm(matrix, axis=1) * np.linalg.norm(query_emb) + 1e-8
+        )
+        best = int(np.argmax(sims))
+        if sims[best] > _SIM_THRESHOLD:
+            return candidates[best][3], query_emb
+    return None, query_emb
+
+def _cache_store(agent_name: str, prompt: str, query_emb: np.ndarray | None, response: str):
+    # never cache degenerate results: error placeholders, arun's "No response."
+    # fallback, or an empty string from a stream that yielded no text — caching
+    # those would pin every future identical run to a blank report
+    if not response or response == "No response." or response.startswith("⚠️"):
+        return
+    st.session_state.prompt_cache[_prompt_key(agent_name, prompt)] = response
+    if query_emb is not None:
+        st.session_state.embedding_index.append((agent_name, query_emb, prompt, response))
+    _persist_cache()
+
+async def cached_arun(agent: GeminiAgent, prompt: str) -> str:
+    """Run an agent through the two-tier cache; repeat or near-duplicate
+    topics (e.g. the example buttons) skip the model call."""
+    cached, query_emb = _cache_lookup(agent.name, prompt)
+    if cached is not None:
+        return cached
+    response = await agent.arun(prompt)
+    _cache_store(agent.name, prompt, query_emb, response)
+    return response
 
 # =========================
-# Agents
+# Batch Mode
 # =========================
-triage_agent = GeminiAgent(
-    name="Triage Agent",
-    instructions=(
-        "You are the coordinator. Given a topic, produce a research plan as pure JSON only.\n"
-        "Keys: topic (string), search_queries (3-5 items), focus_areas (3-5 items).\n"
-        "Do not add commentary outside JSON."
-    ),
-    model="gemini-2.5-flash",
-)
+_BATCH_TERMINAL_STATES = {
+    "JOB_STATE_SUCCEEDED",
+    "JOB_STATE_FAILED",
+    "JOB_STATE_CANCELLED",
+    "JOB_STATE_EXPIRED",
+}
 
-research_agent = GeminiAgent(
-    name="Research Agent",
-    instructions=(
-        "You are a research assistant. Summarize findings in 2-3 short paragraphs, "
-        "under 300 words. Focus on crisp facts, key points, and useful takeaways. "
-        "No fluff. Include bulleted lists if helpful."
-    ),
-    model="gemini-2.5-flash",
-)
+@st.cache_resource(show_spinner=False)
+def _batch_client() -> google_genai.Client:
+    """Client for the google-genai SDK, which serves the Batch Mode endpoint
+    (the google-generativeai package this app otherwise uses has no batch API)."""
+    return google_genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
 
-editor_agent = GeminiAgent(
-    name="Editor Agent",
-    instructions=(
-        "You are a senior researcher. Using the notes, write a comprehensive markdown report "
-        "(>= 1000 words, target ~5-10 pages). Include:\n"
-        "- A clear title\n- An outline of sections\n- Well-structured headings\n"
-        "- Evidence-backed points\n- A 'Sources' section at the end"
-    ),
-    model="gemini-2.5-flash",
-)
+def _batch_generate(calls: list[tuple[str, GeminiAgent, str]]) -> dict[str, str]:
+    """
+    Submit (tag, agent, prompt) calls as a single Gemini Batch Mode job and
+    block until it finishes. Roughly half the cost of the online API, at the
+    price of queueing latency, so only used behind the sidebar toggle.
+    """
+    client = _batch_client()
+    model = calls[0][1].model_name  # the model is job-level; stages are homogeneous
+    inline_requests = [
+        {"contents": agent.build_request(prompt)["contents"]}
+        for _, agent, prompt in calls
+    ]
+    job = client.batches.create(model=model, src=inline_requests)
+    delay = 5.0
+    while job.state.name not in _BATCH_TERMINAL_STATES:
+        time.sleep(delay)
+        delay = min(delay * 2, 60.0)  # exponential backoff while polling
+        job = client.batches.get(name=job.name)
+    results: dict[str, str] = {}
+    if job.state.name == "JOB_STATE_SUCCEEDED":
+        # inlined responses come back in request order, so map by position
+        for (tag, _, _), inline in zip(calls, job.dest.inlined_responses):
+            text = getattr(inline.response, "text", None) if inline.response else None
+            results[tag] = text if text else "No response."
+    return results
+
+async def _stage_calls(
+    calls: list[tuple[str, GeminiAgent, str]], batch_mode: bool
+) -> list[str]:
+    """Run one pipeline stage: a batch job when batch_mode is on, otherwise
+    concurrent online calls through the prompt cache."""
+    if batch_mode:
+        results = await asyncio.to_thread(_batch_generate, calls)
+        return [results.get(tag, "No response.") for tag, _, _ in calls]
+    return list(await asyncio.gather(*[cached_arun(agent, p) for _, agent, p in calls]))
 
-critic_agent = GeminiAgent(
-    name="Critic Agent",
-    instructions=(
-        "You are a critical reviewer. Review the provided report for clarity, structure, depth, "
-        "coverage, and factual balance. Suggest improvements and highlight missing points "
-        "in <= 400 words. Return feedback in markdown with bullet points."
-    ),
-    model="gemini-2.5-flash",
-)
+# =========================
+# Agents (cached across reruns)
+# =========================
+@st.cache_resource(show_spinner=False)
+def get_agents() -> dict[str, GeminiAgent]:
+    """Construct the four agents once per process; Streamlit reruns reuse them."""
+    return make_agents()
+
+agents = get_agents()
+triage_agent = agents["triage"]
+research_agent = agents["research"]
+editor_agent = agents["editor"]
+critic_agent = agents["critic"]
 
 # =========================
 # Sidebar Inputs
@@ -180,6 +295,14 @@ with st.sidebar:
     st.header("Research Topic")
     user_topic = st.text_input("Enter a topic to research:")
     start_button = st.button("Start Research", type="primary", disabled=not user_topic)
+    batch_mode = st.checkbox(
+        "Batch mode (cheaper, slower)",
+        help="Submit each pipeline stage as a Gemini Batch job (~50% cost) instead of the online API.",
+    )
+    full_critique = st.checkbox(
+        "Full-text critique",
+        help="Send the entire report to the Critic instead of a distilled outline (more tokens, marginally deeper review).",
+    )
 
     st.divider()
     st.subheader("Examples")
@@ -208,11 +331,14 @@ tab_process, tab_report = st.tabs(["Research Process", "Report"])
 # =========================
 # Workflow
 # =========================
-def run_research(topic: str):
+async def run_research_async(topic: str, batch_mode: bool = False, full_critique: bool = False):
     st.session_state.collected_facts = []
     st.session_state.research_done = False
     st.session_state.report_result = None
     st.session_state.critique_result = None
+    st.session_state.report_title = None
+    st.session_state.report_bytes = None
+    st.session_state.critique_bytes = None
 
     with tab_process:
         box = st.container()
@@ -220,9 +346,11 @@ def run_research(topic: str):
     # 1) Triage -> Research Plan
     with tab_process:
         box.write("🔧 **Triage Agent**: Creating research plan...")
-    triage_raw = triage_agent.run(f"Topic: {topic}\nReturn JSON only.")
+    [triage_raw] = await _stage_calls(
+        [("triage", triage_agent, f"Topic: {topic}\nReturn JSON only.")], batch_mode
+    )
     fallback_plan = {"topic": topic, "search_queries": [topic], "focus_areas": ["General overview"]}
-    plan_dict = safe_json_parse(triage_raw, fallback=fallback_plan)
+    plan_dict = await _parse_json_async(triage_raw, fallback=fallback_plan)
 
     try:
         plan = ResearchPlan(**plan_dict)
@@ -233,23 +361,31 @@ def run_research(topic: str):
         st.write("📋 **Research Plan**")
         st.json(plan.dict())
 
-    # 2) Research Agent -> Notes
+    # 2) Research Agent -> Notes (one call per query, run concurrently)
     with tab_process:
         box.write("🔎 **Research Agent**: Gathering concise findings...")
-    notes_prompt = (
-        f"Topic: {plan.topic}\n"
-        f"Search Queries: {plan.search_queries}\n"
-        f"Focus Areas: {plan.focus_areas}\n"
-        "Provide concise findings."
+    query_prompts = [
+        (
+            f"Topic: {plan.topic}\n"
+            f"Search Query: {query}\n"
+            f"Focus Areas: {plan.focus_areas}\n"
+            "Provide concise findings."
+        )
+        for query in plan.search_queries
+    ]
+    query_notes = await _stage_calls(
+        [(f"research-{i}", research_agent, p) for i, p in enumerate(query_prompts)],
+        batch_mode,
     )
-    research_notes = research_agent.run(notes_prompt)
 
-    # Store as a single 'fact' entry; you can split later if you want finer granularity
-    st.session_state.collected_facts.append({
-        "fact": research_notes,
-        "source": "Gemini (summarized findings)",
-        "timestamp": datetime.now().strftime("%H:%M:%S"),
-    })
+    # One 'fact' entry per query so the process tab shows where each came from
+    for query, notes in zip(plan.search_queries, query_notes):
+        st.session_state.collected_facts.append({
+            "fact": notes,
+            "source": f"Gemini (query: {query})",
+            "timestamp": datetime.now().strftime("%H:%M:%S"),
+        })
+    research_notes = "\n\n".join(query_notes)
 
     with tab_process:
         st.write("📚 **Collected Findings**")
@@ -263,16 +399,45 @@ def run_research(topic: str):
         f"Topic: {plan.topic}\n\nResearch Notes:\n{research_notes}\n\n"
         "Write the full report now."
     )
-    report_text = editor_agent.run(editor_prompt)
-    st.session_state.report_result = report_text
-
-    # 4) Critic Agent -> Review
+    if batch_mode:
+        [report_text] = await _stage_calls([("editor", editor_agent, editor_prompt)], batch_mode)
+    else:
+        # Stream tokens as they arrive so the user isn't staring at a spinner
+        # for the ~30s a 1000+ word report takes to generate.
+        cached_report, report_emb = _cache_lookup(editor_agent.name, editor_prompt)
+        if cached_report is not None:
+            report_text = cached_report
+        else:
+            try:
+                report_stream = editor_agent.stream(editor_prompt)
+                with tab_process:
+                    report_text = st.write_stream(
+                        chunk.text for chunk in report_stream
+                        if getattr(chunk, "text", None)
+                    )
+                _cache_store(editor_agent.name, editor_prompt, report_emb, report_text)
+            except Exception:
+                # streaming failed mid-flight; fall back to the retrying path
+                report_text = await cached_arun(editor_agent, editor_prompt)
+
+    # 4) Critic Agent -> Review (depends on the full report, so stays sequential)
     with tab_process:
         box.write("🧪 **Critic Agent**: Reviewing the report for improvements...")
-    critique_text = critic_agent.run(report_text)
-    st.session_state.critique_result = critique_text
-
-    st.session_state.research_done = True
+    critic_input = report_text if full_critique else distill_for_critic(report_text)
+    [critique_text] = await _stage_calls([("critic", critic_agent, critic_input)], batch_mode)
+
+    # The critic reads report_text straight from local scope; session state is
+    # written once at the end, batched into a single update() so hosted
+    # Streamlit doesn't serialize the multi-KB strings per individual write.
+    # The title/bytes are precomputed here so reruns don't redo that work.
+    st.session_state.update({
+        "report_result": report_text,
+        "critique_result": critique_text,
+        "report_title": (topic or "Report").title(),
+        "report_bytes": report_text.encode("utf-8"),
+        "critique_bytes": critique_text.encode("utf-8"),
+        "research_done": True,
+    })
 
     with tab_process:
         st.success("✅ Research complete! Draft & review ready.")
@@ -281,37 +446,43 @@ def run_research(topic: str):
 # Trigger
 if start_button and user_topic:
     with st.spinner(f"Working on: {user_topic}"):
-        run_research(user_topic)
+        asyncio.run(run_research_async(user_topic, batch_mode, full_critique))
 
 # =========================
 # Report Tab Rendering
 # =========================
-with tab_report:
-    if st.session_state.get("research_done") and st.session_state.get("report_result"):
-        title_text = (user_topic or "Report").title()
-        st.title(title_text)
-
-        # Full report
-        st.markdown(st.session_state["report_result"])
-
-        # Critic review
-        if st.session_state.get("critique_result"):
-            st.subheader("🧪 Critic Agent Review")
-            st.markdown(st.session_state["critique_result"])
-
-        # Downloads
+@st.fragment
+def render_report():
+    """Render the finished report; a fragment, so interactions inside it
+    (e.g. the download buttons) rerun only this block, not the whole script."""
+    title_text = st.session_state.get("report_title") or "Report"
+    st.title(title_text)
+
+    # Full report
+    st.markdown(st.session_state["report_result"])
+
+    # Critic review
+    if st.session_state.get("critique_result"):
+        st.subheader("🧪 Critic Agent Review")
+        st.markdown(st.session_state["critique_result"])
+
+    # Downloads (bytes pre-encoded at generation time)
+    st.download_button(
+        label="⬇️ Download Report (.md)",
+        data=st.session_state["report_bytes"] or st.session_state["report_result"],
+        file_name=f"{title_text.replace(' ', '_')}.md",
+        mime="text/markdown",
+    )
+    if st.session_state.get("critique_result"):
         st.download_button(
-            label="⬇️ Download Report (.md)",
-            data=st.session_state["report_result"],
-            file_name=f"{title_text.replace(' ', '_')}.md",
+            label="⬇️ Download Critique (.md)",
+            data=st.session_state["critique_bytes"] or st.session_state["critique_result"],
+            file_name=f"{title_text.replace(' ', '_')}_Critique.md",
             mime="text/markdown",
         )
-        if st.session_state.get("critique_result"):
-            st.download_button(
-                label="⬇️ Download Critique (.md)",
-                data=st.session_state["critique_result"],
-                file_name=f"{title_text.replace(' ', '_')}_Critique.md",
-                mime="text/markdown",
-            )
+
+with tab_report:
+    if st.session_state.get("research_done") and st.session_state.get("report_result"):
+        render_report()
     else:
         st.info("Run research from the **Research Process** tab to see the full report and critique here.")
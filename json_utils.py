@@ -0,0 +1,62 @@
+"""
+Shared helpers for pulling JSON objects out of freeform LLM responses.
+Used by both Streamlit entry points (app.py and main.py).
+"""
+
+import re
+import json
+import functools
+
+_FENCE_RE = re.compile(r"```(?:json)?\s*(\{.*?\})\s*```", re.DOTALL)
+
+def _scan_braces(text: str, start: int) -> str | None:
+    """Return the balanced {...} block starting at `start`, or None."""
+    depth = 0
+    in_string = False
+    escape = False
+    for i in range(start, len(text)):
+        ch = text[i]
+        if escape:
+            escape = False
+        elif ch == "\\":
+            escape = True
+        elif ch == '"':
+            in_string = not in_string
+        elif not in_string:
+            if ch == "{":
+                depth += 1
+            elif ch == "}":
+                depth -= 1
+                if depth == 0:
+                    return text[start:i + 1]
+    return None
+
+def extract_json(text: str) -> str | None:
+    """
+    Try to extract a JSON object from a freeform LLM response.
+    Handles code fences and extra text. Single pass over the input;
+    the old greedy {.*} regex could backtrack badly on long reports.
+    """
+    if not text or "{" not in text:
+        return None
+    # Try code-fence first
+    fence = _FENCE_RE.search(text)
+    if fence:
+        return fence.group(1)
+    # Walk from the first '{' tracking brace depth and string/escape state
+    return _scan_braces(text, text.find("{"))
+
+@functools.lru_cache(maxsize=256)
+def _parse_cached(payload: str) -> str | None:
+    """Parse once per distinct payload; returns canonical JSON text or None.
+    Caches the string (dicts aren't hashable) so Streamlit reruns skip re-parsing."""
+    try:
+        return json.dumps(json.loads(payload))
+    except Exception:
+        return None
+
+def safe_json_parse(plan_text: str, fallback: dict) -> dict:
+    payload = extract_json(plan_text) or plan_text
+    parsed = _parse_cached(payload)
+    # json.loads here returns a fresh dict, so callers can't mutate the cache
+    return json.loads(parsed) if parsed is not None else fallback
@@ -6,6 +6,9 @@ from dotenv import load_dotenv
 from pydantic import BaseModel
 import google.generativeai as genai
 
+from agents import make_agents
+from json_utils import safe_json_parse
+
 # Load environment variables
 load_dotenv()
 
@@ -57,21 +60,6 @@ class ResearchReport(BaseModel):
     word_count: int
 
 
-# ---------- Utility: Gemini Wrapper ----------
-class GeminiAgent:
-    def __init__(self, name, instructions, model="gemini-2.5-flash"):
-        self.name = name
-        self.instructions = instructions
-        self.model_name = model
-        self.client = genai.GenerativeModel(model)
-
-    def run(self, prompt: str):
-        """Generate content using Gemini."""
-        full_prompt = f"{self.instructions}\n\nUser query:\n{prompt}"
-        response = self.client.generate_content(full_prompt)
-        return response.text if response and response.text else "No response."
-
-
 # ---------- Custom Tool for Saving Facts ----------
 def save_important_fact(fact: str, source: str = None) -> str:
     """Save an important fact during research."""
@@ -83,30 +71,11 @@ def save_important_fact(fact: str, source: str = None) -> str:
     return f"Fact saved: {fact}"
 
 
-# ---------- Define Agents ----------
-research_agent = GeminiAgent(
-    name="Research Agent",
-    instructions="You are a research assistant. Search the web mentally and summarize findings in 2-3 paragraphs under 300 words. Focus only on core facts, skip fluff.",
-    model="gemini-2.5-flash"
-)
-
-editor_agent = GeminiAgent(
-    name="Editor Agent",
-    instructions="You are a senior researcher. Write a comprehensive research report (1000+ words, markdown format, 5-10 pages). Include an outline, detailed content, and sources.",
-    model="gemini-2.5-flash"
-)
-
-triage_agent = GeminiAgent(
-    name="Triage Agent",
-    instructions="""You are the coordinator. Given a topic:
-1. Create a research plan with:
-   - topic: clear statement
-   - search_queries: 3-5 search queries
-   - focus_areas: 3-5 key aspects
-Return structured JSON with {topic, search_queries, focus_areas}.
-""",
-    model="gemini-2.5-flash"
-)
+# ---------- Define Agents (shared with app.py) ----------
+agents = make_agents()
+triage_agent = agents["triage"]
+research_agent = agents["research"]
+editor_agent = agents["editor"]
 
 # ---------- Sidebar Input ----------
 with st.sidebar:
@@ -144,19 +113,16 @@ def run_research(topic):
         st.write("🔍 **Triage Agent**: Planning research approach...")
 
     triage_output = triage_agent.run(f"Research this topic thoroughly: {topic}")
+    fallback_plan = {
+        "topic": topic,
+        "search_queries": [topic],
+        "focus_areas": ["General overview"]
+    }
+    plan_data = safe_json_parse(triage_output, fallback=fallback_plan)
     try:
-        plan_data = eval(triage_output) if triage_output.strip().startswith("{") else {
-            "topic": topic,
-            "search_queries": [topic],
-            "focus_areas": ["General overview"]
-        }
         research_plan = ResearchPlan(**plan_data)
     except Exception:
-        research_plan = ResearchPlan(
-            topic=topic,
-            search_queries=[topic],
-            focus_areas=["General overview"]
-        )
+        research_plan = ResearchPlan(**fallback_plan)
 
     with message_container:
         st.write("📋 **Research Plan**:")